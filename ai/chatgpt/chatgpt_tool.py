@@ -5,10 +5,17 @@ ChatGPT API工具
 """
 
 import os
+import io
 import json
+import time
+import sqlite3
+import hashlib
+import asyncio
 from typing import List, Dict, Optional
 from dataclasses import dataclass
-from openai import OpenAI
+import numpy as np
+from openai import OpenAI, AsyncOpenAI, RateLimitError, BadRequestError
+from tenacity import retry, wait_random_exponential, stop_after_attempt, retry_if_exception_type
 
 
 @dataclass
@@ -18,6 +25,97 @@ class ChatGPTConfig:
     model: str = 'gpt-3.5-turbo'
     max_tokens: int = 2000
     temperature: float = 0.7
+    concurrency: int = 20
+    max_rpm: int = 500        # 每分钟最大请求数
+    max_tpm: int = 90000      # 每分钟最大token数
+    cache_path: str = ''      # 响应缓存数据库路径，为空则不缓存
+    cache_threshold: float = 0.9
+    embedding_model: str = 'text-embedding-3-small'
+    max_history: int = 50     # 连续对话保留的最大消息数（不含system）
+    cache_control: bool = False  # 为Anthropic兼容接口标记前缀缓存断点
+
+
+class ResponseCache:
+    """响应缓存
+    
+    两级查找: 先按 (model, system_prompt, prompt) 哈希精确匹配，
+    未命中再在同一 (model, system_prompt, embedding_model) 下按embedding余弦相似度匹配。
+    """
+    
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'hash TEXT PRIMARY KEY, scope TEXT, prompt TEXT, embedding BLOB, response TEXT)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_scope ON responses (scope)')
+        self.conn.commit()
+        # scope -> (归一化embedding矩阵, 响应列表)
+        self._index = {}
+    
+    @staticmethod
+    def make_key(*parts: str) -> str:
+        """生成缓存键"""
+        h = hashlib.blake2b(digest_size=16)
+        for part in parts:
+            h.update((part or '').encode('utf-8'))
+            h.update(b'\x00')
+        return h.hexdigest()
+    
+    def get(self, key: str) -> Optional[str]:
+        """精确匹配"""
+        row = self.conn.execute('SELECT response FROM responses WHERE hash = ?', (key,)).fetchone()
+        return row[0] if row else None
+    
+    def _load(self, scope: str) -> list:
+        if scope not in self._index:
+            rows = self.conn.execute(
+                'SELECT embedding, response FROM responses WHERE scope = ? AND embedding IS NOT NULL',
+                (scope,)
+            ).fetchall()
+            if rows:
+                matrix = np.vstack([np.frombuffer(r[0], dtype=np.float32) for r in rows])
+            else:
+                matrix = None
+            # [预留容量的矩阵, 有效行数, 响应列表]
+            self._index[scope] = [matrix, len(rows), [r[1] for r in rows]]
+        return self._index[scope]
+    
+    def search(self, scope: str, embedding: np.ndarray, threshold: float) -> Optional[str]:
+        """相似度匹配，返回相似度最高且不低于阈值的响应"""
+        matrix, count, responses = self._load(scope)
+        if not count:
+            return None
+        
+        sims = matrix[:count] @ embedding
+        best = int(np.argmax(sims))
+        return responses[best] if sims[best] >= threshold else None
+    
+    def put(self, key: str, scope: str, prompt: str, embedding: Optional[np.ndarray], response: str):
+        """写入缓存，embedding为None时只参与精确匹配"""
+        blob = embedding.tobytes() if embedding is not None else None
+        self.conn.execute(
+            'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+            (key, scope, prompt, blob, response)
+        )
+        self.conn.commit()
+        
+        if embedding is not None and scope in self._index:
+            self._append(self._index[scope], embedding, response)
+    
+    @staticmethod
+    def _append(entry: list, embedding: np.ndarray, response: str):
+        """向内存索引追加一行，容量不足时按倍数扩容"""
+        matrix, count, responses = entry
+        if matrix is None or count == matrix.shape[0]:
+            grown = np.empty((max(16, count * 2), embedding.shape[0]), dtype=np.float32)
+            if count:
+                grown[:count] = matrix[:count]
+            matrix = grown
+        
+        matrix[count] = embedding
+        responses.append(response)
+        entry[0], entry[1] = matrix, count + 1
 
 
 class ChatGPT:
@@ -31,16 +129,92 @@ class ChatGPT:
             self.config.api_key = os.environ.get('OPENAI_API_KEY', '')
         
         self.client = OpenAI(api_key=self.config.api_key)
+        self.cache = ResponseCache(self.config.cache_path) if self.config.cache_path else None
         self.conversation_history = []
+        
+        # 令牌桶限流状态
+        self.available_requests = float(self.config.max_rpm)
+        self.available_tokens = float(self.config.max_tpm)
+        self._last_refill = time.monotonic()
+    
+    def ask(self, prompt: str, system_prompt: str = None, semantic: bool = True) -> str:
+        """单次对话
+        
+        semantic=False 时只做精确匹配缓存，适用于结果必须对应原文的翻译、摘要等任务。
+        """
+        if self.cache is None:
+            return self._ask(prompt, system_prompt)
+        
+        scope, key = self._cache_keys(prompt, system_prompt)
+        
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        
+        if not semantic:
+            result = self._ask(prompt, system_prompt)
+            self.cache.put(key, scope, prompt, None, result)
+            return result
+        
+        embedding = self._embed(prompt)
+        cached = self.cache.search(scope, embedding, self.config.cache_threshold)
+        if cached is not None:
+            return cached
+        
+        result = self._ask(prompt, system_prompt)
+        self.cache.put(key, scope, prompt, embedding, result)
+        return result
     
-    def ask(self, prompt: str, system_prompt: str = None) -> str:
-        """单次对话"""
+    def _cache_keys(self, prompt: str, system_prompt: str = None):
+        """返回 (相似度匹配范围, 精确匹配键)"""
+        # 相似度匹配的范围包含向量模型，不同模型的向量维度不同、不可比较
+        scope = ResponseCache.make_key(self.config.model, system_prompt, self.config.embedding_model)
+        key = ResponseCache.make_key(self.config.model, system_prompt, prompt)
+        return scope, key
+    
+    @staticmethod
+    def _build_messages(prompt: str, system_prompt: str = None) -> List[Dict]:
+        """构造单轮对话消息"""
         messages = []
         
         if system_prompt:
             messages.append({'role': 'system', 'content': system_prompt})
         
         messages.append({'role': 'user', 'content': prompt})
+        return messages
+    
+    def ask_n(self, prompt: str, system_prompt: str = None, n: int = 1) -> List[str]:
+        """单次请求返回n个候选结果（使用接口的n参数，只消耗一次输入token）"""
+        if self.cache is None:
+            return self._ask_n(prompt, system_prompt, n)
+        
+        # 多结果按精确键缓存为JSON列表，与单结果分开存放
+        scope = ResponseCache.make_key(self.config.model, system_prompt, f'n={n}')
+        key = ResponseCache.make_key(self.config.model, system_prompt, prompt, f'n={n}')
+        
+        cached = self.cache.get(key)
+        if cached is not None:
+            return json.loads(cached)
+        
+        results = self._ask_n(prompt, system_prompt, n)
+        self.cache.put(key, scope, prompt, None, json.dumps(results, ensure_ascii=False))
+        return results
+    
+    def _ask_n(self, prompt: str, system_prompt: str = None, n: int = 1) -> List[str]:
+        """调用接口获取n个候选结果"""
+        response = self.client.chat.completions.create(
+            model=self.config.model,
+            messages=self._build_messages(prompt, system_prompt),
+            max_tokens=self.config.max_tokens,
+            temperature=self.config.temperature,
+            n=n
+        )
+        
+        return [c.message.content.strip() for c in response.choices if c.message.content]
+    
+    def _ask(self, prompt: str, system_prompt: str = None) -> str:
+        """调用接口完成单次对话"""
+        messages = self._build_messages(prompt, system_prompt)
         
         response = self.client.chat.completions.create(
             model=self.config.model,
@@ -51,13 +225,45 @@ class ChatGPT:
         
         return response.choices[0].message.content
     
-    def chat(self, message: str) -> str:
-        """连续对话"""
+    def _embed(self, text: str) -> np.ndarray:
+        """获取归一化的文本向量"""
+        response = self.client.embeddings.create(
+            model=self.config.embedding_model,
+            input=text
+        )
+        return self._normalize(response.data[0].embedding)
+    
+    async def _embed_async(self, client: AsyncOpenAI, text: str) -> np.ndarray:
+        """异步获取归一化的文本向量"""
+        response = await client.embeddings.create(
+            model=self.config.embedding_model,
+            input=text
+        )
+        return self._normalize(response.data[0].embedding)
+    
+    @staticmethod
+    def _normalize(values: List[float]) -> np.ndarray:
+        embedding = np.asarray(values, dtype=np.float32)
+        return embedding / (np.linalg.norm(embedding) or 1.0)
+    
+    def chat(self, message: str, system_prompt: str = None) -> str:
+        """连续对话
+        
+        system_prompt 仅在对话开始时设置一次，保证请求前缀在多轮之间保持不变。
+        """
+        if system_prompt and not self.conversation_history:
+            self.conversation_history.append({'role': 'system', 'content': system_prompt})
+        
         self.conversation_history.append({'role': 'user', 'content': message})
+        self._trim_history()
+        
+        messages = self.conversation_history
+        if self.config.cache_control:
+            messages = self._mark_cache(messages)
         
         response = self.client.chat.completions.create(
             model=self.config.model,
-            messages=self.conversation_history,
+            messages=messages,
             max_tokens=self.config.max_tokens,
             temperature=self.config.temperature
         )
@@ -67,23 +273,211 @@ class ChatGPT:
         
         return reply
     
+    def _trim_history(self):
+        """只保留最近 max_history 条消息，system消息始终保留在最前"""
+        system = [m for m in self.conversation_history if m['role'] == 'system']
+        others = [m for m in self.conversation_history if m['role'] != 'system']
+        
+        if len(others) > self.config.max_history:
+            self.conversation_history = system + others[-self.config.max_history:]
+    
+    @staticmethod
+    def _mark(message: Dict) -> Dict:
+        """为单条消息添加 ephemeral 缓存标记"""
+        return {
+            'role': message['role'],
+            'content': [{
+                'type': 'text',
+                'text': message['content'],
+                'cache_control': {'type': 'ephemeral'}
+            }]
+        }
+    
+    @classmethod
+    def _mark_cache(cls, messages: List[Dict]) -> List[Dict]:
+        """在system和倒数第二条消息上设置缓存断点，不修改原历史"""
+        marked = list(messages)
+        
+        if marked and marked[0]['role'] == 'system':
+            marked[0] = cls._mark(marked[0])
+        if len(marked) >= 3:
+            marked[-2] = cls._mark(marked[-2])
+        
+        return marked
+    
     def clear_history(self):
         """清空对话历史"""
         self.conversation_history = []
         print("对话历史已清空")
     
     def batch_generate(self, prompts: List[str], system_prompt: str = None) -> List[str]:
-        """批量生成"""
-        results = []
+        """批量生成（并发请求）"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self._batch_async(prompts, system_prompt, self.config.concurrency))
         
+        raise RuntimeError(
+            "batch_generate 不能在运行中的事件循环（如Jupyter）里调用，"
+            "请改用 await gpt.abatch_generate(...)"
+        )
+    
+    async def abatch_generate(self, prompts: List[str], system_prompt: str = None) -> List[str]:
+        """批量生成的异步版本，可在已有事件循环中 await"""
+        return await self._batch_async(prompts, system_prompt, self.config.concurrency)
+    
+    def batch_submit(self, prompts: List[str], system_prompt: str = None,
+                     poll_interval: int = 30) -> List[str]:
+        """通过Batch API离线批量生成
+        
+        费用约为同步接口的一半且不占用RPM额度，但结果最长可能需要24小时返回，
+        适合非实时的大批量任务。返回结果顺序与prompts一致。
+        """
+        lines = []
         for i, prompt in enumerate(prompts):
-            try:
-                result = self.ask(prompt, system_prompt)
-                results.append(result)
+            lines.append(json.dumps({
+                'custom_id': f'request-{i}',
+                'method': 'POST',
+                'url': '/v1/chat/completions',
+                'body': {
+                    'model': self.config.model,
+                    'messages': self._build_messages(prompt, system_prompt),
+                    'max_tokens': self.config.max_tokens,
+                    'temperature': self.config.temperature
+                }
+            }, ensure_ascii=False))
+        
+        payload = io.BytesIO('\n'.join(lines).encode('utf-8'))
+        batch_file = self.client.files.create(file=('batch.jsonl', payload), purpose='batch')
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint='/v1/chat/completions',
+            completion_window='24h'
+        )
+        print(f"已提交批处理任务 {batch.id}，共 {len(prompts)} 条")
+        
+        while batch.status not in ('completed', 'failed', 'expired', 'cancelled'):
+            time.sleep(poll_interval)
+            batch = self.client.batches.retrieve(batch.id)
+            print(f"批处理状态: {batch.status}")
+        
+        if batch.status == 'failed':
+            raise RuntimeError(f"批处理失败: {batch.errors}")
+        
+        results = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            
+            for line in self.client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                
+                item = json.loads(line)
+                response = item.get('response') or {}
+                if item.get('error') or response.get('status_code') != 200:
+                    error = item.get('error') or response.get('body', {}).get('error')
+                    results[item['custom_id']] = f"Error: {error}"
+                else:
+                    results[item['custom_id']] = response['body']['choices'][0]['message']['content']
+        
+        return [
+            results.get(f'request-{i}', f"Error: 批处理状态 {batch.status}，无结果")
+            for i in range(len(prompts))
+        ]
+    
+    def _refill(self):
+        """按时间补充请求数与token额度"""
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        
+        self.available_requests = min(
+            self.config.max_rpm,
+            self.available_requests + elapsed * self.config.max_rpm / 60
+        )
+        self.available_tokens = min(
+            self.config.max_tpm,
+            self.available_tokens + elapsed * self.config.max_tpm / 60
+        )
+    
+    async def _acquire(self, tokens: int):
+        """等待直到请求数和token额度都足够"""
+        # 单个请求超过桶容量时按容量计，避免永久等待
+        tokens = min(tokens, self.config.max_tpm)
+        
+        while True:
+            self._refill()
+            if self.available_requests >= 1 and self.available_tokens >= tokens:
+                self.available_requests -= 1
+                self.available_tokens -= tokens
+                return
+            await asyncio.sleep(0.01)
+    
+    @retry(
+        wait=wait_random_exponential(min=1, max=60),
+        stop=stop_after_attempt(6),
+        retry=retry_if_exception_type(RateLimitError),
+        reraise=True
+    )
+    async def _create_async(self, client: AsyncOpenAI, messages: List[Dict]):
+        """异步调用接口，遇到429时指数退避重试"""
+        return await client.chat.completions.create(
+            model=self.config.model,
+            messages=messages,
+            max_tokens=self.config.max_tokens,
+            temperature=self.config.temperature
+        )
+    
+    async def _ask_async(self, client: AsyncOpenAI, prompt: str, system_prompt: str,
+                         sem: asyncio.Semaphore) -> str:
+        """异步单次对话，受信号量和令牌桶限制；与 ask() 一样先查响应缓存"""
+        embedding = None
+        if self.cache is not None:
+            scope, key = self._cache_keys(prompt, system_prompt)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        
+        messages = self._build_messages(prompt, system_prompt)
+        
+        # 粗略估算: 约4个字符一个token，加上最大输出token
+        tokens = (len(prompt) + len(system_prompt or '')) // 4 + self.config.max_tokens
+        
+        async with sem:
+            if self.cache is not None:
+                embedding = await self._embed_async(client, prompt)
+                cached = self.cache.search(scope, embedding, self.config.cache_threshold)
+                if cached is not None:
+                    return cached
+            
+            await self._acquire(tokens)
+            response = await self._create_async(client, messages)
+        
+        result = response.choices[0].message.content
+        if self.cache is not None:
+            self.cache.put(key, scope, prompt, embedding, result)
+        return result
+    
+    async def _batch_async(self, prompts: List[str], system_prompt: str = None,
+                           concurrency: int = 20) -> List[str]:
+        """并发执行批量请求，结果顺序与prompts一致"""
+        sem = asyncio.Semaphore(concurrency)
+        
+        # 异步客户端的连接池绑定在当前事件循环上，每次 asyncio.run 都要新建
+        # 关闭SDK自带重试，退避统一由 _create_async 的 tenacity 负责
+        async with AsyncOpenAI(api_key=self.config.api_key, max_retries=0) as client:
+            tasks = [self._ask_async(client, prompt, system_prompt, sem) for prompt in prompts]
+            responses = await asyncio.gather(*tasks, return_exceptions=True)
+        
+        results = []
+        for i, response in enumerate(responses):
+            if isinstance(response, Exception):
+                results.append(f"Error: {response}")
+                print(f"[{i+1}/{len(prompts)}] 失败: {response}")
+            else:
+                results.append(response)
                 print(f"[{i+1}/{len(prompts)}] 完成")
-            except Exception as e:
-                results.append(f"Error: {e}")
-                print(f"[{i+1}/{len(prompts)}] 失败: {e}")
         
         return results
 
@@ -91,27 +485,50 @@ class ChatGPT:
 class ContentGenerator:
     """内容生成器"""
     
-    def __init__(self, api_key: str = ''):
-        self.gpt = ChatGPT(ChatGPTConfig(api_key=api_key))
+    # system提示保持固定不变，可变内容只放在最后的user消息中，便于命中前缀缓存
+    TITLE_SYSTEM_PROMPT = "你是专业的内容创作者。每个标题单独一行，不要编号。"
+    DESCRIPTION_SYSTEM_PROMPT = "你是专业电商文案。每个描述100字以内，单独一行，不要编号。"
+    SOCIAL_SYSTEM_PROMPT = "你是社交媒体运营专家。每条帖子单独一行，不要编号。"
+    SUMMARY_SYSTEM_PROMPT = "你是专业编辑。"
+    TRANSLATE_SYSTEM_PROMPT = "你是专业翻译，只返回翻译结果。"
+    
+    def __init__(self, api_key: str = '', cache_path: str = ''):
+        self.gpt = ChatGPT(ChatGPTConfig(api_key=api_key, cache_path=cache_path))
+    
+    def _generate(self, prompt: str, fallback_prompt: str, system_prompt: str, count: int) -> List[str]:
+        """用n参数一次请求生成count个结果；接口不支持n>1时退回到按行拆分
+        
+        部分兼容接口会忽略n参数只返回一个结果，数量不足时同样退回。
+        """
+        try:
+            results = self.gpt.ask_n(prompt, system_prompt, n=count)
+            if len(results) >= count:
+                return results[:count]
+        except BadRequestError:
+            pass
+        
+        result = self.gpt.ask(fallback_prompt, system_prompt)
+        items = [line.strip() for line in result.split('\n') if line.strip()]
+        return items[:count]
     
     def generate_titles(self, topic: str, count: int = 10) -> List[str]:
         """生成标题"""
-        prompt = f"为'{topic}'生成{count}个吸引人的标题，每个标题用换行分隔"
-        result = self.gpt.ask(prompt, "你是专业的内容创作者")
-        
-        titles = [t.strip() for t in result.split('\n') if t.strip()]
-        return titles[:count]
+        prompt = f"主题: {topic}\n\n生成一个吸引人的标题"
+        fallback_prompt = f"主题: {topic}\n\n生成{count}个吸引人的标题"
+        return self._generate(prompt, fallback_prompt, self.TITLE_SYSTEM_PROMPT, count)
     
     def generate_descriptions(self, product_name: str, features: List[str], count: int = 5) -> List[str]:
         """生成商品描述"""
-        prompt = f"""为'{product_name}'生成{count}个商品描述。
+        context = f"""商品: {product_name}
 特点: {', '.join(features)}
-每个描述100字以内，用换行分隔。"""
-        
-        result = self.gpt.ask(prompt, "你是专业电商文案")
-        
-        descriptions = [d.strip() for d in result.split('\n') if d.strip()]
-        return descriptions[:count]
+
+"""
+        return self._generate(
+            context + "生成一个商品描述",
+            context + f"生成{count}个商品描述",
+            self.DESCRIPTION_SYSTEM_PROMPT,
+            count
+        )
     
     def generate_social_posts(self, topic: str, platform: str = 'wechat', count: int = 5) -> List[str]:
         """生成社交媒体帖子"""
@@ -122,27 +539,46 @@ class ContentGenerator:
             'zhihu': '知乎风格，专业详细'
         }
         
-        prompt = f"用{platform_hints.get(platform, '普通')}为'{topic}'生成{count}条社交媒体帖子"
-        result = self.gpt.ask(prompt, "你是社交媒体运营专家")
-        
-        posts = [p.strip() for p in result.split('\n') if p.strip()]
-        return posts[:count]
+        context = f"主题: {topic}\n风格: {platform_hints.get(platform, '普通')}\n\n"
+        return self._generate(
+            context + "生成一条社交媒体帖子",
+            context + f"生成{count}条社交媒体帖子",
+            self.SOCIAL_SYSTEM_PROMPT,
+            count
+        )
     
-    def summarize_text(self, text: str, length: str = 'medium') -> str:
-        """摘要"""
+    @staticmethod
+    def _summary_prompt(text: str, length: str) -> str:
         lengths = {
             'short': '一句话总结',
             'medium': '100字总结',
             'long': '200字总结'
         }
-        
-        prompt = f"{lengths.get(length, lengths['medium'])}:\n\n{text[:3000]}"
-        return self.gpt.ask(prompt, "你是专业编辑")
+        return f"{lengths.get(length, lengths['medium'])}:\n\n{text[:3000]}"
+    
+    @staticmethod
+    def _translate_prompt(text: str, target: str) -> str:
+        return f"翻译成{target}:\n\n{text[:2000]}"
+    
+    def summarize_text(self, text: str, length: str = 'medium') -> str:
+        """摘要"""
+        return self.gpt.ask(self._summary_prompt(text, length), self.SUMMARY_SYSTEM_PROMPT,
+                            semantic=False)
     
     def translate_text(self, text: str, target: str = 'Chinese') -> str:
         """翻译"""
-        prompt = f"将以下文本翻译成{target}，只返回翻译结果:\n\n{text[:2000]}"
-        return self.gpt.ask(prompt)
+        return self.gpt.ask(self._translate_prompt(text, target), self.TRANSLATE_SYSTEM_PROMPT,
+                            semantic=False)
+    
+    def batch_summarize(self, texts: List[str], length: str = 'medium') -> List[str]:
+        """批量摘要（Batch API，适合非实时任务）"""
+        prompts = [self._summary_prompt(text, length) for text in texts]
+        return self.gpt.batch_submit(prompts, self.SUMMARY_SYSTEM_PROMPT)
+    
+    def batch_translate(self, texts: List[str], target: str = 'Chinese') -> List[str]:
+        """批量翻译（Batch API，适合非实时任务）"""
+        prompts = [self._translate_prompt(text, target) for text in texts]
+        return self.gpt.batch_submit(prompts, self.TRANSLATE_SYSTEM_PROMPT)
 
 
 class EmailGenerator:
@@ -186,10 +622,14 @@ if __name__ == "__main__":
     
     # 内容生成
     # generator = ContentGenerator()
+    # generator = ContentGenerator(cache_path="chatgpt_cache.db")  # 开启响应缓存
     # titles = generator.generate_titles("Python编程", 5)
     # for t in titles:
     #     print(f"- {t}")
     
+    # 离线批量翻译（Batch API）
+    # translations = generator.batch_translate(["Hello", "Good morning"], target="中文")
+    
     # 邮件生成
     # email_gen = EmailGenerator()
     # email = email_gen.write_email(
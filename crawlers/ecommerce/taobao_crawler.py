@@ -4,13 +4,19 @@
 支持淘宝/京东/拼多多/亚马逊等平台
 """
 
-import requests
-from bs4 import BeautifulSoup
-import json
-import time
+import httpx
+from lxml import etree
+import lxml.html
+import os
+import orjson
+import math
+import asyncio
 import random
-from typing import List, Dict
+from typing import List, Dict, Iterable, Iterator
 from dataclasses import dataclass
+from functools import lru_cache
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 
 
 @dataclass
@@ -24,121 +30,290 @@ class Product:
     platform: str
 
 
+def _has_class(name: str) -> str:
+    """与CSS类选择器 .name 等价的XPath条件"""
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+# 编码来自服务器响应，限制缓存数量
+@lru_cache(maxsize=16)
+def _html_parser(encoding: str = None) -> lxml.html.HTMLParser:
+    """按编码缓存解析器；encoding为None时由lxml根据<meta charset>识别"""
+    return lxml.html.HTMLParser(encoding=encoding, recover=True)
+
+
+def _parse_html(response: httpx.Response):
+    """解析页面，编码优先取HTTP头的charset，其次<meta charset>，都没有时按UTF-8"""
+    encoding = response.charset_encoding
+    if encoding is None and b'charset' not in response.content[:2048].lower():
+        encoding = 'utf-8'
+    
+    try:
+        parser = _html_parser(encoding)
+    except LookupError:
+        # 服务器声明了lxml不认识的编码，改由lxml自行识别
+        parser = _html_parser(None)
+    return lxml.html.fromstring(response.content, parser=parser)
+
+
+# 预编译XPath，避免每个商品重复解析选择器
+HREF_XP = etree.XPath("string((.//a)[1]/@href)")
+
+TAOBAO_ITEMS_XP = etree.XPath(f"//*[{_has_class('item')}]")
+TAOBAO_TITLE_XP = etree.XPath(f"normalize-space(.//*[{_has_class('title')}])")
+TAOBAO_PRICE_XP = etree.XPath(f"normalize-space(.//*[{_has_class('price')}])")
+TAOBAO_SALES_XP = etree.XPath(f"normalize-space(.//*[{_has_class('sales')}])")
+TAOBAO_SHOP_XP = etree.XPath(f"normalize-space(.//*[{_has_class('shop')}])")
+
+JD_ITEMS_XP = etree.XPath(f"//*[{_has_class('gl-item')}]")
+JD_NAME_XP = etree.XPath(f"normalize-space(.//*[{_has_class('p-name')}])")
+JD_PRICE_XP = etree.XPath(f"normalize-space(.//*[{_has_class('p-price')}])")
+JD_SHOP_XP = etree.XPath(f"normalize-space(.//*[{_has_class('p-shop')}])")
+
+
+class ProductTable:
+    """按列存储的商品集合
+    
+    每个字段一个列表，避免逐个创建对象；需要逐行访问时可迭代得到 Product。
+    """
+    
+    FIELDS = ('name', 'price', 'sales', 'shop', 'url', 'platform')
+    
+    def __init__(self):
+        self.cols: Dict[str, list] = {field: [] for field in self.FIELDS}
+    
+    def append(self, name: str, price: float, sales: str, shop: str, url: str, platform: str):
+        """追加一行"""
+        cols = self.cols
+        cols['name'].append(name)
+        cols['price'].append(price)
+        cols['sales'].append(sales)
+        cols['shop'].append(shop)
+        cols['url'].append(url)
+        cols['platform'].append(platform)
+    
+    def extend(self, products: Iterable[Product]):
+        """追加多行，可以是另一个 ProductTable 或任意 Product 序列"""
+        if isinstance(products, ProductTable):
+            for field in self.FIELDS:
+                self.cols[field].extend(products.cols[field])
+        else:
+            for p in products:
+                self.append(p.name, p.price, p.sales, p.shop, p.url, p.platform)
+    
+    @classmethod
+    def from_products(cls, products: Iterable[Product]) -> 'ProductTable':
+        """由 Product 序列构建"""
+        table = cls()
+        table.extend(products)
+        return table
+    
+    def __add__(self, other: Iterable[Product]) -> 'ProductTable':
+        table = ProductTable.from_products(self)
+        table.extend(other)
+        return table
+    
+    def __radd__(self, other: Iterable[Product]) -> 'ProductTable':
+        table = ProductTable.from_products(other)
+        table.extend(self)
+        return table
+    
+    def to_arrow(self) -> pa.Table:
+        """转换为 pyarrow.Table"""
+        return pa.table({
+            'name': pa.array(self.cols['name'], pa.string()),
+            'price': pa.array(self.cols['price'], pa.float64()),
+            'sales': pa.array(self.cols['sales'], pa.string()),
+            'shop': pa.array(self.cols['shop'], pa.string()),
+            'url': pa.array(self.cols['url'], pa.string()),
+            'platform': pa.array(self.cols['platform'], pa.string()),
+        })
+    
+    def __len__(self) -> int:
+        return len(self.cols['name'])
+    
+    def __getitem__(self, index):
+        """按下标取 Product，按切片取新的 ProductTable"""
+        if isinstance(index, slice):
+            table = ProductTable()
+            table.cols = {field: values[index] for field, values in self.cols.items()}
+            return table
+        return Product(*(self.cols[field][index] for field in self.FIELDS))
+    
+    def __iter__(self) -> Iterator[Product]:
+        for row in zip(*(self.cols[field] for field in self.FIELDS)):
+            yield Product(*row)
+
+
+class HumanDelay:
+    """模拟人工浏览的请求间隔
+    
+    间隔服从对数正态分布，并每隔若干次请求插入一次较长的"阅读停顿"。
+    档位由环境变量 OPENCLI_DELAY_PROFILE 指定 (fast | moderate | slow)，默认 moderate。
+    """
+    
+    PROFILES = {
+        # 中位数(秒), sigma, 最小值, 最大值, 停顿间隔范围, 停顿时长范围
+        'fast': dict(median=1.0, sigma=0.4, low=0.5, high=4.0, every=(25, 40), pause=(3, 8)),
+        'moderate': dict(median=2.0, sigma=0.5, low=1.0, high=8.0, every=(15, 25), pause=(5, 15)),
+        'slow': dict(median=4.0, sigma=0.6, low=2.0, high=15.0, every=(10, 15), pause=(10, 30)),
+    }
+    
+    def __init__(self, profile: str = None):
+        profile = profile or os.environ.get('OPENCLI_DELAY_PROFILE', 'moderate')
+        self.profile = self.PROFILES.get(profile, self.PROFILES['moderate'])
+        self.count = 0
+        self.next_pause = random.randint(*self.profile['every'])
+    
+    def sample(self) -> float:
+        """返回下一次请求前应等待的秒数"""
+        p = self.profile
+        delay = math.exp(random.gauss(math.log(p['median']), p['sigma']))
+        return min(max(delay, p['low']), p['high'])
+    
+    def take_break(self) -> float:
+        """记录一次请求；到达停顿点时返回停顿秒数，否则返回0"""
+        self.count += 1
+        if self.count < self.next_pause:
+            return 0.0
+        
+        self.count = 0
+        self.next_pause = random.randint(*self.profile['every'])
+        return random.uniform(*self.profile['pause'])
+
+
 class EcommerceCrawler:
     """电商爬虫"""
     
-    def __init__(self):
+    def __init__(self, concurrency: int = 4, delay_profile: str = None):
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
         }
-        self.session = requests.Session()
-        self.session.headers.update(self.headers)
+        self.concurrency = concurrency
+        self.limits = httpx.Limits(max_connections=20)
+        self.delay = HumanDelay(delay_profile)
     
-    def crawl_taobao(self, keyword: str, pages: int = 5) -> List[Product]:
+    async def _fetch_all(self, urls: List[str]) -> List:
+        """并发抓取页面，HTTP/2复用连接；信号量限制同时请求数并保留人工间隔"""
+        sem = asyncio.Semaphore(self.concurrency)
+        # 阅读停顿期间清除，所有抓取任务都在发请求前等待
+        resume = asyncio.Event()
+        resume.set()
+        
+        async with httpx.AsyncClient(http2=True, headers=self.headers, timeout=10,
+                                     limits=self.limits, follow_redirects=True) as client:
+            async def fetch(url: str):
+                async with sem:
+                    await resume.wait()
+                    pause = self.delay.take_break()
+                    if pause:
+                        resume.clear()
+                        await asyncio.sleep(pause)
+                        resume.set()
+                    
+                    await asyncio.sleep(self.delay.sample())
+                    await resume.wait()
+                    return await client.get(url)
+            
+            return await asyncio.gather(*(fetch(u) for u in urls), return_exceptions=True)
+    
+    async def crawl_taobao(self, keyword: str, pages: int = 5) -> ProductTable:
         """爬取淘宝商品"""
-        products = []
+        products = ProductTable()
+        urls = [f"https://s.taobao.com/search?q={keyword}&page={page}" for page in range(1, pages + 1)]
         
-        for page in range(1, pages + 1):
-            url = f"https://s.taobao.com/search?q={keyword}&page={page}"
+        for response in await self._fetch_all(urls):
+            if isinstance(response, Exception):
+                print(f"爬取失败: {response}")
+                continue
             
             try:
-                response = self.session.get(url, timeout=10)
-                soup = BeautifulSoup(response.text, 'lxml')
-                
-                items = soup.select('.item')
+                tree = _parse_html(response)
                 
-                for item in items:
+                for item in TAOBAO_ITEMS_XP(tree):
                     try:
-                        name = item.select_one('.title').get_text(strip=True) if item.select_one('.title') else ''
-                        price = item.select_one('.price').get_text(strip=True) if item.select_one('.price') else '0'
-                        sales = item.select_one('.sales').get_text(strip=True) if item.select_one('.sales') else '0'
-                        shop = item.select_one('.shop').get_text(strip=True) if item.select_one('.shop') else ''
-                        url = item.select_one('a')['href'] if item.select_one('a') else ''
+                        name = TAOBAO_TITLE_XP(item)
+                        price = TAOBAO_PRICE_XP(item) or '0'
+                        sales = TAOBAO_SALES_XP(item) or '0'
+                        shop = TAOBAO_SHOP_XP(item)
+                        url = HREF_XP(item)
                         
-                        products.append(Product(
+                        products.append(
                             name=name,
                             price=float(price.replace('¥', '')),
                             sales=sales,
                             shop=shop,
                             url=url,
                             platform='淘宝'
-                        ))
+                        )
                     except:
                         continue
                 
-                time.sleep(random.uniform(1, 3))
-                
             except Exception as e:
                 print(f"爬取失败: {e}")
                 continue
         
         return products
     
-    def crawl_jd(self, keyword: str, pages: int = 5) -> List[Product]:
+    async def crawl_jd(self, keyword: str, pages: int = 5) -> ProductTable:
         """爬取京东商品"""
-        products = []
+        products = ProductTable()
+        urls = [f"https://search.jd.com/Search?keyword={keyword}&page={page}" for page in range(1, pages + 1)]
         
-        for page in range(1, pages + 1):
-            url = f"https://search.jd.com/Search?keyword={keyword}&page={page}"
+        for response in await self._fetch_all(urls):
+            if isinstance(response, Exception):
+                print(f"爬取失败: {response}")
+                continue
             
             try:
-                response = self.session.get(url, timeout=10)
-                soup = BeautifulSoup(response.text, 'lxml')
-                
-                items = soup.select('.gl-item')
+                tree = _parse_html(response)
                 
-                for item in items:
+                for item in JD_ITEMS_XP(tree):
                     try:
-                        name = item.select_one('.p-name').get_text(strip=True) if item.select_one('.p-name') else ''
-                        price = item.select_one('.p-price').get_text(strip=True) if item.select_one('.p-price') else '0'
-                        shop = item.select_one('.p-shop').get_text(strip=True) if item.select_one('.p-shop') else ''
-                        url = 'https:' + item.select_one('a')['href'] if item.select_one('a') else ''
+                        name = JD_NAME_XP(item)
+                        price = JD_PRICE_XP(item) or '0'
+                        shop = JD_SHOP_XP(item)
+                        href = HREF_XP(item)
+                        url = 'https:' + href if href else ''
                         
-                        products.append(Product(
+                        products.append(
                             name=name,
                             price=float(price.replace('¥', '')),
                             sales='0',
                             shop=shop,
                             url=url,
                             platform='京东'
-                        ))
+                        )
                     except:
                         continue
                 
-                time.sleep(random.uniform(1, 3))
-                
             except Exception as e:
                 print(f"爬取失败: {e}")
                 continue
         
         return products
     
-    def save_to_csv(self, products: List[Product], filename: str = 'products.csv'):
+    def save_to_csv(self, products: Iterable[Product], filename: str = 'products.csv'):
         """保存到CSV"""
-        import csv
+        if not isinstance(products, ProductTable):
+            products = ProductTable.from_products(products)
         
-        with open(filename, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(['名称', '价格', '销量', '店铺', '链接', '平台'])
-            
-            for p in products:
-                writer.writerow([p.name, p.price, p.sales, p.shop, p.url, p.platform])
+        table = products.to_arrow().rename_columns(['名称', '价格', '销量', '店铺', '链接', '平台'])
+        pa_csv.write_csv(table, filename)
         
         print(f"已保存 {len(products)} 个商品到 {filename}")
     
-    def save_to_json(self, products: List[Product], filename: str = 'products.json'):
+    def save_to_json(self, products: Iterable[Product], filename: str = 'products.json'):
         """保存到JSON"""
-        data = [{
-            'name': p.name,
-            'price': p.price,
-            'sales': p.sales,
-            'shop': p.shop,
-            'url': p.url,
-            'platform': p.platform
-        } for p in products]
+        if not isinstance(products, ProductTable):
+            products = ProductTable.from_products(products)
+        
+        fields = ProductTable.FIELDS
+        data = [dict(zip(fields, row)) for row in zip(*(products.cols[f] for f in fields))]
         
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        # orjson直接输出UTF-8字节，非ASCII字符不转义
+        with open(filename, 'wb') as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
         
         print(f"已保存 {len(products)} 个商品到 {filename}")
 
@@ -149,7 +324,7 @@ if __name__ == "__main__":
     
     # 爬取淘宝
     print("爬取淘宝商品...")
-    products = crawler.crawl_taobao("手机", pages=2)
+    products = asyncio.run(crawler.crawl_taobao("手机", pages=2))
     
     # 保存结果
     crawler.save_to_csv(products, 'taobao_products.csv')
@@ -4,17 +4,36 @@ Excel自动化工具
 支持合并/拆分/汇总/格式转换
 """
 
+import os
+import re
 import pandas as pd
 import openpyxl
-from typing import List, Dict
+from typing import List, Dict, Tuple
 from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import polars as pl
+    import fastexcel  # noqa: F401  polars 读取Excel依赖
+except ImportError:
+    pl = None
+
+
+# 单元格数字格式
+NUMBER_FORMATS = {
+    'currency': '¥#,##0.00',
+    'percent': '0.00%',
+    'date': 'YYYY-MM-DD',
+}
 
 
 @dataclass
 class ExcelConfig:
     """Excel配置"""
-    engine: str = 'openpyxl'
+    engine: str = 'calamine'        # 读取引擎 (calamine 比 openpyxl 快数倍)
+    write_engine: str = 'openpyxl'  # 写入引擎 (calamine 只支持读取)
     header_row: int = 0
+    defer_writes: bool = False      # 修改操作只更新内存，调用 flush() 时才写回
 
 
 class ExcelTools:
@@ -22,30 +41,119 @@ class ExcelTools:
     
     def __init__(self, config: ExcelConfig = None):
         self.config = config or ExcelConfig()
+        # 路径 -> (读取时的修改时间, DataFrame)，连续修改同一文件时只解析一次
+        self._cache: Dict[str, Tuple[float, pd.DataFrame]] = {}
+        self._dirty: Dict[str, bool] = {}
+        self._defer = self.config.defer_writes
+    
+    def __enter__(self):
+        """with 块内的修改延迟写入，退出时统一写回"""
+        self._defer = True
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self._defer = self.config.defer_writes
+        self.flush()
+    
+    def _load(self, filepath: str) -> pd.DataFrame:
+        """读取并缓存DataFrame；文件在外部被修改时重新读取"""
+        key = os.path.abspath(filepath)
+        cached = self._cache.get(key)
+        
+        if cached is not None:
+            mtime, df = cached
+            if self._dirty.get(key) or mtime == os.path.getmtime(key):
+                return df
+        
+        df = self.read(filepath)
+        self._cache[key] = (os.path.getmtime(key), df)
+        return df
+    
+    def _update(self, filepath: str, df: pd.DataFrame):
+        """更新缓存并标记为待写入；未开启延迟写入时立即写回"""
+        key = os.path.abspath(filepath)
+        self._cache[key] = (self._cache[key][0], df)
+        self._dirty[key] = True
+        
+        if not self._defer:
+            self.flush(filepath)
+    
+    def flush(self, filepath: str = None):
+        """将修改过的数据写回文件，不指定路径时写回全部"""
+        keys = [os.path.abspath(filepath)] if filepath else list(self._dirty)
+        
+        for key in keys:
+            if not self._dirty.pop(key, False):
+                continue
+            
+            df = self._cache[key][1]
+            self.write(df, key)
+            self._cache[key] = (os.path.getmtime(key), df)
     
     def read(self, filepath: str) -> pd.DataFrame:
         """读取Excel"""
+        # 先写回未保存的修改，保证读到最新数据
+        self.flush(filepath)
         return pd.read_excel(
             filepath,
             engine=self.config.engine,
             header=self.config.header_row
         )
     
-    def write(self, df: pd.DataFrame, filepath: str, sheet_name: str = 'Sheet1'):
-        """写入Excel"""
-        df.to_excel(
-            filepath,
-            sheet_name=sheet_name,
-            engine=self.config.engine,
-            index=False
-        )
+    def write(self, df: pd.DataFrame, filepath: str, sheet_name: str = 'Sheet1',
+              formats: Dict[str, str] = None):
+        """写入Excel
+        
+        Args:
+            formats: 列格式 {列名: 'currency' | 'percent' | 'date'}，指定时使用xlsxwriter按列设置格式
+        """
+        # 文件被覆盖，原有缓存失效
+        key = os.path.abspath(filepath)
+        self._cache.pop(key, None)
+        self._dirty.pop(key, None)
+        
+        if not formats:
+            df.to_excel(
+                filepath,
+                sheet_name=sheet_name,
+                engine=self.config.write_engine,
+                index=False
+            )
+            return
+        
+        with pd.ExcelWriter(filepath, engine='xlsxwriter') as writer:
+            self._write_sheet(writer, df, sheet_name, formats)
+    
+    @staticmethod
+    def _write_sheet(writer: pd.ExcelWriter, df: pd.DataFrame, sheet_name: str,
+                     formats: Dict[str, str] = None):
+        """写入单个工作表，并对整列设置数字格式"""
+        df.to_excel(writer, sheet_name=sheet_name, index=False)
+        
+        if not formats:
+            return
+        
+        worksheet = writer.sheets[sheet_name]
+        for column, format_type in formats.items():
+            if column in df.columns and format_type in NUMBER_FORMATS:
+                col_idx = df.columns.get_loc(column)
+                fmt = writer.book.add_format({'num_format': NUMBER_FORMATS[format_type]})
+                worksheet.set_column(col_idx, col_idx, None, fmt)
+                
+                # pandas为日期单元格单独设置了格式，会覆盖列格式，需要按单元格重写
+                if pd.api.types.is_datetime64_any_dtype(df[column]):
+                    for row, value in enumerate(df[column], start=1):
+                        if pd.isna(value):
+                            worksheet.write_blank(row, col_idx, None, fmt)
+                        else:
+                            worksheet.write_datetime(row, col_idx, value.to_pydatetime(), fmt)
     
     def merge_files(self, files: List[str], output: str, add_source: bool = True):
         """合并多个Excel文件"""
         dfs = []
         
         for f in files:
-            if pd.io.excel.exists_excel(f):
+            if os.path.exists(f):
                 df = self.read(f)
                 if add_source:
                     df['source_file'] = f
@@ -60,75 +168,111 @@ class ExcelTools:
         """按列值拆分Excel"""
         df = self.read(filepath)
         
-        import os
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
         
-        for value in df[column].unique():
-            subset = df[df[column] == value]
-            filename = f"{value}.xlsx"
-            filepath = f"{output_dir}/{filename}"
-            self.write(subset, filepath)
-            print(f"已保存 {filepath}")
+        # 一次分组代替按值逐个过滤；各文件写入相互独立，用线程并行
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            futures = []
+            used = set()
+            for value, subset in df.groupby(column, sort=False, dropna=False):
+                # 不同的值清洗后可能同名 (如 'a b' 与 'a/b')，追加序号保证文件名唯一
+                stem = re.sub(r'[^\w]', '_', str(value))
+                name, n = stem, 1
+                while name.lower() in used:
+                    n += 1
+                    name = f"{stem}_{n}"
+                used.add(name.lower())
+                
+                filepath = os.path.join(output_dir, name + '.xlsx')
+                futures.append((filepath, pool.submit(self.write, subset, filepath)))
+            
+            for filepath, future in futures:
+                future.result()
+                print(f"已保存 {filepath}")
     
     def add_formula(self, filepath: str, column: str, formula: str, result_column: str):
-        """添加公式列"""
-        df = self.read(filepath)
+        """添加公式列（延迟写入模式下暂存在内存中，flush() 时写回）"""
+        df = self._load(filepath)
         df[result_column] = df.eval(formula)
-        self.write(df, filepath)
+        self._update(filepath, df)
         print(f"已添加公式列: {result_column}")
     
     def summarize(self, filepath: str, group_by: str, columns: List[str], output: str):
-        """汇总统计"""
-        df = self.read(filepath)
-        
-        agg_dict = {col: ['sum', 'mean', 'count'] for col in columns}
-        summary = df.groupby(group_by).agg(agg_dict)
+        """汇总统计（安装了polars时使用多线程分组聚合）"""
+        if pl is not None:
+            self.flush(filepath)
+            summary = (
+                pl.read_excel(filepath, engine='calamine',
+                              read_options={'header_row': self.config.header_row})
+                .lazy()
+                .drop_nulls(group_by)  # 与pandas groupby一致，丢弃分组键为空的行
+                .group_by(group_by)
+                .agg([
+                    expr
+                    for col in columns
+                    for expr in (
+                        pl.col(col).sum().alias(f'{col}_sum'),
+                        pl.col(col).mean().alias(f'{col}_mean'),
+                        pl.col(col).count().alias(f'{col}_count'),
+                    )
+                ])
+                .sort(group_by)
+                .collect()
+                .to_pandas()
+            )
+        else:
+            df = self.read(filepath)
+            
+            agg_dict = {col: ['sum', 'mean', 'count'] for col in columns}
+            summary = df.groupby(group_by).agg(agg_dict)
+            
+            # 扁平化列名
+            summary.columns = ['_'.join(col).strip() for col in summary.columns.values]
+            summary = summary.reset_index()
         
-        # 扁平化列名
-        summary.columns = ['_'.join(col).strip() for col in summary.columns.values]
-        self.write(summary.reset_index(), output)
+        self.write(summary, output)
         print(f"已保存汇总到 {output}")
     
     def format_cells(self, filepath: str, column: str, format_type: str = 'currency'):
-        """格式化单元格"""
+        """格式化单元格
+        
+        已有文件用openpyxl原地修改，保留公式、样式和其他工作表；
+        由本工具生成的文件可直接用 write(..., formats=...) 按列设置格式。
+        """
+        self.flush(filepath)
         wb = openpyxl.load_workbook(filepath)
         ws = wb.active
         
         # 查找列索引
-        header = [cell.value for cell in ws[1]]
-        if column in header:
+        header_row = self.config.header_row + 1
+        header = [cell.value for cell in ws[header_row]]
+        number_format = NUMBER_FORMATS.get(format_type)
+        if column in header and number_format:
             col_idx = header.index(column) + 1
             
-            for row in range(2, ws.max_row + 1):
-                cell = ws.cell(row=row, column=col_idx)
-                
-                if format_type == 'currency':
-                    cell.number_format = '¥#,##0.00'
-                elif format_type == 'percent':
-                    cell.number_format = '0.00%'
-                elif format_type == 'date':
-                    cell.number_format = 'YYYY-MM-DD'
+            for (cell,) in ws.iter_rows(min_row=header_row + 1, min_col=col_idx, max_col=col_idx):
+                cell.number_format = number_format
         
         wb.save(filepath)
         print(f"已格式化 {column} 列")
     
     def remove_duplicates(self, filepath: str, subset: List[str] = None):
-        """去除重复行"""
-        df = self.read(filepath)
+        """去除重复行（延迟写入模式下暂存在内存中，flush() 时写回）"""
+        df = self._load(filepath)
         original_len = len(df)
         
         df = df.drop_duplicates(subset=subset)
         
         removed = original_len - len(df)
-        self.write(df, filepath)
+        self._update(filepath, df)
         print(f"已去除 {removed} 个重复行")
     
     def fill_empty(self, filepath: str, column: str, value: str = '0'):
-        """填充空值"""
-        df = self.read(filepath)
+        """填充空值（延迟写入模式下暂存在内存中，flush() 时写回）"""
+        df = self._load(filepath)
         df[column] = df[column].fillna(value)
-        self.write(df, filepath)
+        self._update(filepath, df)
         print(f"已填充 {column} 列的空值")
     
     def convert_format(self, input_file: str, output_file: str, output_format: str = 'csv'):
@@ -161,4 +305,10 @@ if __name__ == "__main__":
     # 格式转换
     # excel.convert_format("data.xlsx", "data.csv", "csv")
     
+    # 连续修改同一文件只读取一次，退出 with 块时统一写回
+    # with ExcelTools() as excel:
+    #     excel.fill_empty("data.xlsx", "数量")
+    #     excel.remove_duplicates("data.xlsx")
+    #     excel.add_formula("data.xlsx", "数量", "单价 * 数量", "金额")
+    
     print("Excel工具已就绪！")
@@ -5,32 +5,115 @@
 """
 
 import os
+import mmap
 import shutil
-import hashlib
 import time
+from collections import defaultdict
+from functools import cached_property
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Callable, Optional
+from typing import List, Dict, Callable, Iterator, Optional
 from datetime import datetime
+from blake3 import blake3
+
+
+class FileInfo(dict):
+    """文件信息
+    
+    哈希在首次通过 info.hash、info['hash'] 或 info.get('hash') 访问时才计算。
+    哈希不是字典中的键：'hash' in info、items()、json.dumps(info) 都不包含它。
+    """
+    
+    @cached_property
+    def hash(self) -> str:
+        return FileManager.get_file_hash(self['path'])
+    
+    def __missing__(self, key):
+        if key == 'hash':
+            return self.hash
+        raise KeyError(key)
+    
+    def get(self, key, default=None):
+        if key == 'hash' and key not in self:
+            return self.hash
+        return super().get(key, default)
 
 
 class FileManager:
     """文件管理器"""
     
+    HEAD_SIZE = 4096
+    
+    @staticmethod
+    def _scan(directory: str) -> Iterator[os.DirEntry]:
+        """递归遍历目录，返回文件的DirEntry
+        
+        与 os.walk 顺序一致：先返回当前目录的文件，再依次进入子目录；
+        不进入符号链接目录，无法读取的目录直接跳过。
+        """
+        try:
+            it = os.scandir(directory)
+        except OSError:
+            return
+        
+        subdirs = []
+        with it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                
+                if is_dir:
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                else:
+                    yield entry
+        
+        for subdir in subdirs:
+            yield from FileManager._scan(subdir)
+    
+    @staticmethod
+    def _match_ext(name: str, exts: frozenset) -> bool:
+        """文件名是否以集合中任一扩展名结尾（支持 tar.gz 这类多段扩展名）"""
+        name = name.lower()
+        i = name.find('.')
+        while i != -1:
+            if name[i:] in exts:
+                return True
+            i = name.find('.', i + 1)
+        return False
+    
     @staticmethod
     def get_files(directory: str, extensions: List[str] = None) -> List[str]:
         """获取文件列表"""
-        files = []
-        for root, dirs, filenames in os.walk(directory):
-            for f in filenames:
-                if extensions is None or any(f.endswith(f'.{ext}') for ext in extensions):
-                    files.append(os.path.join(root, f))
-        return files
+        if extensions is None:
+            return [entry.path for entry in FileManager._scan(directory)]
+        
+        exts = frozenset('.' + ext.lower() for ext in extensions)
+        return [
+            entry.path for entry in FileManager._scan(directory)
+            if FileManager._match_ext(entry.name, exts)
+        ]
     
     @staticmethod
     def get_file_hash(filepath: str) -> str:
-        """获取文件MD5哈希"""
+        """获取文件BLAKE3哈希
+        
+        通过mmap按需读入，内存占用与文件大小无关；小文件直接读取。
+        """
+        with open(filepath, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < 4096:
+                return blake3(f.read()).hexdigest()
+            
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return blake3(mm).hexdigest()
+    
+    @staticmethod
+    def _read_head(filepath: str) -> bytes:
+        """读取文件头部，用于去重预筛选"""
         with open(filepath, 'rb') as f:
-            return hashlib.md5(f.read()).hexdigest()
+            return f.read(FileManager.HEAD_SIZE)
     
     @staticmethod
     def batch_rename(directory: str, pattern: str = None,
@@ -45,21 +128,21 @@ class FileManager:
             suffix: 后缀
             start: 起始编号
         """
-        files = FileManager.get_files(directory)
+        # 先完整收集再重命名，避免遍历过程中遇到已重命名的文件
+        entries = [(entry.path, entry.name) for entry in FileManager._scan(directory)]
+        date = datetime.now().strftime('%Y%m%d')
         count = 0
         
-        for i, filepath in enumerate(files):
-            dirname = os.path.dirname(filepath)
-            ext = os.path.splitext(filepath)[1]
-            filename = os.path.splitext(os.path.basename(filepath))[0]
+        for i, (filepath, name) in enumerate(entries):
+            dirname = filepath[:-len(name)]
             
             if pattern:
-                new_name = pattern.format(i=i + start, date=datetime.now().strftime('%Y%m%d'))
+                new_name = pattern.format(i=i + start, date=date)
             else:
+                filename, ext = os.path.splitext(name)
                 new_name = f"{prefix}{filename}{suffix}{ext}"
             
-            new_path = os.path.join(dirname, new_name)
-            os.rename(filepath, new_path)
+            os.rename(filepath, dirname + new_name)
             count += 1
         
         print(f"已重命名 {count} 个文件")
@@ -113,16 +196,38 @@ class FileManager:
         hashes = {}
         deleted = 0
         file_sizes = {}
+        to_hash = []
         
-        # 收集文件信息
+        # 先按大小分组，大小唯一的文件不可能重复
+        by_size = defaultdict(list)
         for filepath in files:
-            file_hash = FileManager.get_file_hash(filepath)
-            file_sizes[filepath] = os.path.getsize(filepath)
+            file_sizes[filepath] = os.stat(filepath).st_size
+            by_size[file_sizes[filepath]].append(filepath)
+        
+        for size, group in by_size.items():
+            if len(group) < 2:
+                continue
             
-            if file_hash in hashes:
-                hashes[file_hash].append(filepath)
-            else:
-                hashes[file_hash] = [filepath]
+            # 再按文件头分组，只有大小和文件头都相同的才计算完整哈希
+            by_head = defaultdict(list)
+            for filepath in group:
+                by_head[FileManager._read_head(filepath)].append(filepath)
+            
+            for head, candidates in by_head.items():
+                if len(candidates) < 2:
+                    continue
+                
+                # 不超过文件头长度的文件，文件头即全部内容
+                if size <= FileManager.HEAD_SIZE:
+                    hashes[(size, head)] = candidates
+                else:
+                    to_hash.extend(candidates)
+        
+        # 多线程计算完整哈希，重叠磁盘读取与计算
+        workers = min(32, (os.cpu_count() or 1) * 2)
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            for filepath, file_hash in zip(to_hash, ex.map(FileManager.get_file_hash, to_hash)):
+                hashes.setdefault((file_sizes[filepath], file_hash), []).append(filepath)
         
         # 删除重复
         for file_hash, file_list in hashes.items():
@@ -187,26 +292,24 @@ class FileManager:
     def count_files(directory: str) -> Dict[str, int]:
         """统计文件数量"""
         counts = {}
-        files = FileManager.get_files(directory)
         
-        for filepath in files:
-            ext = Path(filepath).suffix.lower()
+        for entry in FileManager._scan(directory):
+            ext = os.path.splitext(entry.name)[1].lower()
             counts[ext] = counts.get(ext, 0) + 1
         
         return counts
     
     @staticmethod
-    def get_file_info(filepath: str) -> Dict:
+    def get_file_info(filepath: str) -> FileInfo:
         """获取文件信息"""
         stat = os.stat(filepath)
-        return {
-            'path': filepath,
-            'name': os.path.basename(filepath),
-            'size': stat.st_size,
-            'created': datetime.fromtimestamp(stat.st_ctime).strftime('%Y-%m-%d %H:%M:%S'),
-            'modified': datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M:%S'),
-            'hash': FileManager.get_file_hash(filepath)
-        }
+        return FileInfo(
+            path=filepath,
+            name=os.path.basename(filepath),
+            size=stat.st_size,
+            created=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stat.st_ctime)),
+            modified=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stat.st_mtime))
+        )
 
 
 # 示例使用